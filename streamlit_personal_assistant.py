@@ -10,10 +10,14 @@ Single-file Streamlit app implementing:
 
 Requirements (put in requirements.txt):
 streamlit
+numpy
 openai
 tiktoken (optional for token counting)
 python-dotenv
-PyPDF2
+pypdfium2
+tenacity
+sentence-transformers[onnx] (optional, enables the semantic response cache)
+diskcache (optional, keeps cached responses across restarts)
 
 Usage:
 1. pip install -r requirements.txt
@@ -25,9 +29,19 @@ This app uses OpenAI's API by default but is written to allow swapping to other
 """
 
 import streamlit as st
+import numpy as np
 import os
 import time
-from typing import Tuple, List
+import asyncio
+import re
+import json
+import hashlib
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Callable, Dict, FrozenSet, Iterator, Optional, Tuple, List
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 # Optional: use dotenv to load API key from .env
 try:
@@ -40,38 +54,621 @@ except Exception:
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", None)
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")  # change as needed
 API_BACKEND = os.getenv("API_BACKEND", "openai")  # or 'hf' etc.
-
-# Minimal wrapper to call OpenAI (can be swapped with other providers)
-def call_openai(prompt: str, system: str = "", temperature: float = 0.7, max_tokens: int = 400) -> str:
-    """Call OpenAI's chat completions. Expects OPENAI_API_KEY env var to be set."""
+OPENAI_CONTEXT_TOKENS = int(os.getenv("OPENAI_CONTEXT_TOKENS", "128000"))  # context window of OPENAI_MODEL
+PROMPT_OVERHEAD_TOKENS = 500  # room kept for system instructions and message framing
+OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")  # for notes retrieval
+RATE_LIMIT_MAX_WAIT = 60  # seconds; longest pause before a request when OpenAI reports a limit is used up
+STREAM_RENDER_INTERVAL = 0.05  # seconds between redraws of a streaming response
+FAN_OUT_CONCURRENCY = 8  # max in-flight requests when running several prompts at once
+RAG_CHUNK_CHARS = 2000  # ~500 tokens per notes chunk for retrieval
+RAG_TOP_K = 4  # notes chunks sent with each Q&A question
+BATCH_CHUNK_CHARS = 6000  # notes per request when queueing Q&A for the Batch API
+CACHE_MAX_ENTRIES = 512  # exact-match response cache size
+CACHE_MAX_TEMPERATURE = 0.7  # only cache fairly deterministic calls
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", ".llm_cache")  # on-disk cache shared across restarts (needs diskcache)
+LLM_CACHE_TTL = 86400  # seconds a cached response stays on disk
+SEMANTIC_CACHE_MODEL = "sentence-transformers/all-MiniLM-L6-v2"  # local embedder for near-duplicate inputs
+SEMANTIC_CACHE_THRESHOLD = 0.92  # cosine similarity needed to reuse a response
+SEMANTIC_CACHE_MAX_ENTRIES = 256  # per scope, per user
+
+# ---- OpenAI clients (created once per process, not on every Streamlit rerun) ----
+@st.cache_resource
+def _openai():
+    """The openai module, imported on first use, or None if it isn't installed."""
     try:
         import openai
     except Exception:
+        return None
+    return openai
+
+# SDK-level retries are off: transient failures are retried with backoff by _create_completion & co.
+@st.cache_resource
+def _openai_client():
+    return _openai().OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+@st.cache_resource
+def _async_openai_client():
+    return _openai().AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+@st.cache_resource
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """Long-lived event loop on a daemon thread, so the shared async client's connections stay on one loop."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="openai-async", daemon=True).start()
+    return loop
+
+def _client_error() -> Optional[str]:
+    """User-facing reason the OpenAI client is unavailable, or None if it's ready."""
+    if _openai() is None:
         return "Error: openai package not installed. Install with `pip install openai`."
-
     if not OPENAI_API_KEY:
         return "Error: OPENAI_API_KEY not set."
+    return None
 
-    openai.api_key = OPENAI_API_KEY
+def _build_messages(prompt: str, system: str = "") -> List[dict]:
     messages = []
     if system:
         messages.append({"role": "system", "content": system})
     messages.append({"role": "user", "content": prompt})
+    return messages
+
+# ---- Retries & rate limiting ----
+@st.cache_resource(show_spinner=False)
+def _rate_limits(model: str) -> dict:
+    """Latest x-ratelimit-* budget OpenAI reported for a model, shared by all sessions and decremented locally per request."""
+    return {"requests": None, "tokens": None, "requests_reset_at": 0.0, "tokens_reset_at": 0.0, "lock": threading.Lock()}
+
+def _parse_reset(value: str) -> float:
+    """Seconds in an x-ratelimit-reset-* header such as '20ms', '1s' or '6m0s'."""
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(num) * units[unit] for num, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value or ""))
+
+def _record_rate_limits(model: str, headers) -> None:
+    state = _rate_limits(model)
+    now = time.monotonic()
+    with state["lock"]:
+        for kind in ("requests", "tokens"):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining is not None:
+                state[kind] = int(float(remaining))
+                state[f"{kind}_reset_at"] = now + _parse_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+
+def _reserve_rate_limit(model: str, tokens: int) -> float:
+    """Count a request about to be sent against the model's known budget; return seconds to wait before sending it."""
+    state = _rate_limits(model)
+    now = time.monotonic()
+    delay = 0.0
+    with state["lock"]:
+        if state["requests"] is not None:
+            if state["requests"] <= 0:
+                delay = max(delay, state["requests_reset_at"] - now)
+            state["requests"] -= 1
+        if state["tokens"] is not None:
+            if state["tokens"] < tokens:
+                delay = max(delay, state["tokens_reset_at"] - now)
+            state["tokens"] -= tokens
+    return min(max(delay, 0.0), RATE_LIMIT_MAX_WAIT)
+
+def _estimate_tokens(kwargs: dict) -> int:
+    """Rough token cost of a request (~4 characters per token) plus its completion budget."""
+    chars = sum(len(m["content"]) for m in kwargs.get("messages", []))
+    chars += sum(len(t) for t in kwargs.get("input", []))
+    return chars // 4 + kwargs.get("max_tokens", 0)
+
+def _is_transient(e: BaseException) -> bool:
+    """Rate limits, connection problems and 5xx responses are worth retrying; other errors are not."""
+    openai = _openai()
+    if openai is None or getattr(e, "code", None) == "insufficient_quota":  # a 429 for billing, not throttling
+        return False
+    return isinstance(e, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError))
+
+_retry_transient = retry(
+    retry=retry_if_exception(_is_transient),
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+
+@_retry_transient
+def _create_completion(**kwargs):
+    time.sleep(_reserve_rate_limit(kwargs["model"], _estimate_tokens(kwargs)))
+    raw = _openai_client().chat.completions.with_raw_response.create(**kwargs)
+    _record_rate_limits(kwargs["model"], raw.headers)
+    return raw.parse()
+
+@_retry_transient
+async def _acreate_completion(**kwargs):
+    await asyncio.sleep(_reserve_rate_limit(kwargs["model"], _estimate_tokens(kwargs)))
+    raw = await _async_openai_client().chat.completions.with_raw_response.create(**kwargs)
+    _record_rate_limits(kwargs["model"], raw.headers)
+    return raw.parse()
+
+@_retry_transient
+def _create_embeddings(**kwargs):
+    time.sleep(_reserve_rate_limit(kwargs["model"], _estimate_tokens(kwargs)))
+    raw = _openai_client().embeddings.with_raw_response.create(**kwargs)
+    _record_rate_limits(kwargs["model"], raw.headers)
+    return raw.parse()
+
+# Batch endpoints aren't rate-limited per request like completions, but share the retry policy
+@_retry_transient
+def _upload_batch_file(**kwargs):
+    return _openai_client().files.create(**kwargs)
+
+@_retry_transient
+def _create_batch(**kwargs):
+    return _openai_client().batches.create(**kwargs)
+
+@_retry_transient
+def _retrieve_batch(batch_id: str):
+    return _openai_client().batches.retrieve(batch_id)
+
+@_retry_transient
+def _file_text(file_id: str) -> str:
+    return _openai_client().files.content(file_id).text
+
+# ---- Response cache ----
+@st.cache_resource
+def _response_cache() -> dict:
+    """Process-wide LRU of completed responses, shared across reruns and sessions."""
+    return {"store": OrderedDict(), "hits": 0, "misses": 0, "lock": threading.Lock()}
+
+@st.cache_resource
+def _disk_cache():
+    """Persistent cache under LLM_CACHE_DIR that survives app restarts, or None if diskcache is unavailable."""
+    try:
+        import diskcache
+        return diskcache.Cache(LLM_CACHE_DIR, size_limit=2_000_000_000)
+    except Exception:
+        return None
+
+def _cache_key(prompt: str, system: str, temperature: float, max_tokens: int) -> str:
+    raw = json.dumps([OPENAI_MODEL, system, prompt, temperature, max_tokens])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def cache_lookup(prompt: str, system: str = "", temperature: float = 0.7, max_tokens: int = 400) -> Optional[str]:
+    """Return a previously stored response for this exact request, or None."""
+    if temperature > CACHE_MAX_TEMPERATURE:
+        return None
+    cache = _response_cache()
+    key = _cache_key(prompt, system, temperature, max_tokens)
+    with cache["lock"]:
+        resp = cache["store"].get(key)
+        if resp is not None:
+            cache["store"].move_to_end(key)
+            cache["hits"] += 1
+            return resp
+    disk = _disk_cache()
+    resp = disk.get(key) if disk is not None else None
+    with cache["lock"]:
+        if resp is None:
+            cache["misses"] += 1
+            return None
+        cache["hits"] += 1
+        cache["store"][key] = resp  # warm the in-memory tier
+        while len(cache["store"]) > CACHE_MAX_ENTRIES:
+            cache["store"].popitem(last=False)
+        return resp
+
+def cache_store(prompt: str, system: str, temperature: float, max_tokens: int, resp: str) -> None:
+    if temperature > CACHE_MAX_TEMPERATURE or not resp:
+        return
+    cache = _response_cache()
+    key = _cache_key(prompt, system, temperature, max_tokens)
+    with cache["lock"]:
+        cache["store"][key] = resp
+        cache["store"].move_to_end(key)
+        while len(cache["store"]) > CACHE_MAX_ENTRIES:
+            cache["store"].popitem(last=False)
+    disk = _disk_cache()
+    if disk is not None:
+        disk.set(key, resp, expire=LLM_CACHE_TTL)
+
+# ---- Semantic cache (optional: needs sentence-transformers) ----
+@st.cache_resource(show_spinner=False)
+def _local_embedder():
+    """Load the MiniLM sentence encoder once per process, or return None if unavailable."""
+    try:
+        from sentence_transformers import SentenceTransformer
+    except Exception:
+        return None
+    try:
+        return SentenceTransformer(SEMANTIC_CACHE_MODEL, backend="onnx")
+    except Exception:
+        pass
+    try:
+        return SentenceTransformer(SEMANTIC_CACHE_MODEL)
+    except Exception:
+        return None
+
+def embed_local(text: str) -> Optional[np.ndarray]:
+    """Unit-length embedding of text, or None when no local embedder is installed or text is too long for it."""
+    model = _local_embedder()
+    if model is None:
+        return None
+    try:
+        # MiniLM only reads the first max_seq_length word pieces; longer texts sharing an opening would collide
+        if len(model.tokenizer.tokenize(text)) > model.max_seq_length - 2:
+            return None
+        return np.asarray(model.encode(text, normalize_embeddings=True), dtype=np.float32)
+    except Exception:
+        return None
+
+def _semantic_owner() -> Optional[str]:
+    """Email of the signed-in user when Streamlit auth is configured, else None."""
+    try:
+        return st.user.get("email") if st.user.get("is_logged_in") else None
+    except Exception:
+        return None
+
+# Entries are (embedding matrix, responses, expiry times) per scope. Responses can quote a user's own question,
+# so they're only persisted on disk under a signed-in user's email; anonymous visitors keep them in their session.
+def _semantic_key(scope: str) -> Optional[str]:
+    owner = _semantic_owner()
+    if owner is None or _disk_cache() is None:
+        return None
+    return f"semantic:{OPENAI_MODEL}:{hashlib.sha256(owner.encode('utf-8')).hexdigest()}:{scope}"
+
+def _semantic_live(entry, now: float) -> Optional[Tuple[np.ndarray, List[str], np.ndarray]]:
+    """Drop rows whose own TTL has passed."""
+    if entry is None:
+        return None
+    matrix, responses, expires = entry
+    keep = expires > now
+    if keep.all():
+        return entry
+    return matrix[keep], [r for r, k in zip(responses, keep) if k], expires[keep]
+
+def _semantic_entry(scope: str) -> Optional[Tuple[np.ndarray, List[str], np.ndarray]]:
+    key = _semantic_key(scope)
+    entry = _disk_cache().get(key) if key else st.session_state.setdefault("semantic_cache", {}).get(scope)
+    return _semantic_live(entry, time.time())
+
+def semantic_lookup(scope: str, query: str) -> Tuple[Optional[str], Optional[np.ndarray]]:
+    """Return (cached response, query embedding) for the closest earlier input in this scope."""
+    emb = embed_local(query)
+    if emb is None:
+        return None, None
+    entry = _semantic_entry(scope)
+    if entry is not None and entry[1]:
+        matrix, responses, _ = entry
+        sims = matrix @ emb  # rows are unit length, so this is cosine similarity
+        best = int(np.argmax(sims))
+        if sims[best] >= SEMANTIC_CACHE_THRESHOLD:
+            return responses[best], emb
+    return None, emb
+
+def semantic_store(scope: str, emb: np.ndarray, resp: str) -> None:
+    now = time.time()
+
+    def _append(entry) -> Tuple[np.ndarray, List[str], np.ndarray]:
+        empty = (np.empty((0, emb.shape[0]), dtype=np.float32), [], np.empty(0))
+        matrix, responses, expires = _semantic_live(entry, now) or empty
+        n = SEMANTIC_CACHE_MAX_ENTRIES
+        return (np.vstack([matrix, emb])[-n:], (responses + [resp])[-n:],
+                np.append(expires, now + LLM_CACHE_TTL)[-n:])
+
+    key = _semantic_key(scope)
+    if key:
+        disk = _disk_cache()
+        with disk.transact():  # read-modify-write, so two tabs of the same user don't drop each other's entries
+            # Each row carries its own expiry; the key itself just outlives the newest row
+            disk.set(key, _append(disk.get(key)), expire=LLM_CACHE_TTL)
+    else:
+        caches = st.session_state.setdefault("semantic_cache", {})
+        caches[scope] = _append(caches.get(scope))
+
+# Minimal wrapper to call OpenAI (can be swapped with other providers)
+def call_openai(prompt: str, system: str = "", temperature: float = 0.7, max_tokens: int = 400) -> str:
+    """Call OpenAI's chat completions. Expects OPENAI_API_KEY env var to be set."""
+    cached = cache_lookup(prompt, system, temperature, max_tokens)
+    if cached is not None:
+        return cached
+
+    error = _client_error()
+    if error:
+        return error
 
     try:
         # Updated for openai python >=1.0.0
-        resp = openai.chat.completions.create(
+        resp = _create_completion(
             model=OPENAI_MODEL,
-            messages=messages,
+            messages=_build_messages(prompt, system),
             temperature=temperature,
             max_tokens=max_tokens,
         )
-        return resp.choices[0].message.content.strip()
+        text = resp.choices[0].message.content.strip()
     except Exception as e:
         return f"OpenAI API error: {e}"
+    cache_store(prompt, system, temperature, max_tokens, text)
+    return text
+
+# Async variant for firing several requests concurrently (see call_openai_many)
+async def call_openai_async(prompt: str, system: str = "", temperature: float = 0.7, max_tokens: int = 400) -> str:
+    """Async counterpart of call_openai, sharing the same response cache."""
+    cached = cache_lookup(prompt, system, temperature, max_tokens)
+    if cached is not None:
+        return cached
+
+    error = _client_error()
+    if error:
+        return error
+
+    try:
+        resp = await _acreate_completion(
+            model=OPENAI_MODEL,
+            messages=_build_messages(prompt, system),
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+        text = resp.choices[0].message.content.strip()
+    except Exception as e:
+        return f"OpenAI API error: {e}"
+    cache_store(prompt, system, temperature, max_tokens, text)
+    return text
+
+def call_openai_many(prompts: Dict[str, Tuple[str, str]], temperature: float = 0.7, max_tokens: int = 400,
+                     on_result: Optional[Callable[[str, str], None]] = None) -> Dict[str, str]:
+    """Run several named (system, prompt) pairs concurrently (at most FAN_OUT_CONCURRENCY in flight).
+
+    on_result(name, text) is called as each response arrives, so the UI can fill in results in completion order.
+    """
+    loop = _event_loop()
+
+    async def _new_semaphore() -> asyncio.Semaphore:
+        return asyncio.Semaphore(FAN_OUT_CONCURRENCY)
+
+    async def _one(sem: asyncio.Semaphore, name: str, system: str, prompt: str) -> Tuple[str, str]:
+        async with sem:
+            return name, await call_openai_async(prompt, system, temperature, max_tokens)
+
+    sem = asyncio.run_coroutine_threadsafe(_new_semaphore(), loop).result()
+    futures = [asyncio.run_coroutine_threadsafe(_one(sem, name, system, p), loop) for name, (system, p) in prompts.items()]
+    results = {}
+    # Collected on the calling (script) thread, where on_result may update Streamlit elements
+    for fut in concurrent.futures.as_completed(futures):
+        name, text = fut.result()
+        results[name] = text
+        if on_result is not None:
+            on_result(name, text)
+    return results
+
+# Streaming variant: yields text deltas so the UI can render tokens as they arrive
+def call_openai_stream(prompt: str, system: str = "", temperature: float = 0.7, max_tokens: int = 400,
+                       on_complete: Optional[Callable[[str], None]] = None) -> Iterator[str]:
+    """Stream OpenAI's chat completions, yielding each new piece of text as it arrives.
+
+    on_complete is called with the final text once the stream finishes without error.
+    """
+    error = _client_error()
+    if error:
+        yield error
+        return
+
+    parts = []
+    try:
+        resp = _create_completion(
+            model=OPENAI_MODEL,
+            messages=_build_messages(prompt, system),
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+        for chunk in resp:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if delta:
+                parts.append(delta)
+                yield delta
+    except Exception as e:
+        yield ("\n\n" if parts else "") + f"OpenAI API error: {e}"
+        return
+    text = "".join(parts).strip()
+    cache_store(prompt, system, temperature, max_tokens, text)
+    if on_complete is not None and text:
+        on_complete(text)
+
+# Render a streamed response into a placeholder and return the final text.
+# Deltas are collected in a list and only joined when the placeholder is redrawn; redraws are throttled,
+# since each one copies and ships the whole text so far.
+def stream_to(placeholder, stream: Iterator[str], prefix: str = "", as_code: bool = False) -> str:
+    def _render(text: str) -> None:
+        if as_code:
+            placeholder.code(text)
+        else:
+            placeholder.markdown(prefix + text)
+
+    parts, rendered, last_render = [], 0, 0.0
+    for delta in stream:
+        parts.append(delta)
+        now = time.monotonic()
+        if now - last_render >= STREAM_RENDER_INTERVAL:
+            _render("".join(parts))
+            rendered, last_render = len(parts), now
+    text = "".join(parts)
+    if rendered != len(parts) or not parts:
+        _render(text)
+    return text.strip()
+
+# Serve from the response caches when possible, otherwise stream a fresh completion.
+# scope/query enable the semantic cache: query is the raw user input, scope everything else that shapes the answer.
+def render_response(placeholder, prompt: str, system: str = "", temperature: float = 0.7, max_tokens: int = 400,
+                    prefix: str = "", as_code: bool = False, scope: Optional[str] = None, query: Optional[str] = None) -> str:
+    cached = cache_lookup(prompt, system, temperature, max_tokens)
+    if cached is not None:
+        resp = stream_to(placeholder, iter([cached]), prefix=prefix, as_code=as_code)
+        st.caption("♻️ cached")
+        return resp
+
+    on_complete = None
+    if scope and query and temperature <= CACHE_MAX_TEMPERATURE:
+        similar, emb = semantic_lookup(scope, query)
+        if similar is not None:
+            resp = stream_to(placeholder, iter([similar]), prefix=prefix, as_code=as_code)
+            st.caption("♻️ cached (similar request)")
+            return resp
+        if emb is not None:
+            on_complete = lambda text: semantic_store(scope, emb, text)
+
+    stream = call_openai_stream(prompt, system, temperature, max_tokens, on_complete=on_complete)
+    return stream_to(placeholder, stream, prefix=prefix, as_code=as_code)
+
+# ---- Batch API (asynchronous, 24h window, half price) ----
+def _split_long(para: str, max_chars: int) -> Iterator[str]:
+    """Cut an oversized paragraph at the last line break, else sentence end, else hard at max_chars."""
+    while len(para) > max_chars:
+        window = para[:max_chars]
+        cut = window.rfind("\n")
+        if cut <= 0:
+            cut = window.rfind(". ") + 1
+        if cut <= 0:
+            cut = max_chars
+        yield para[:cut].strip()
+        para = para[cut:].strip()
+    yield para
+
+def split_into_chunks(text: str, max_chars: int) -> List[str]:
+    """Greedily pack paragraphs into chunks of at most max_chars (long paragraphs are split at line/sentence ends)."""
+    chunks, current, size = [], [], 0
+    for para in text.replace("\r\n", "\n").split("\n\n"):
+        para = para.strip()
+        if not para:
+            continue
+        if current and (size + len(para) > max_chars or len(para) > max_chars):
+            chunks.append("\n\n".join(current))
+            current, size = [], 0
+        *pieces, para = _split_long(para, max_chars)
+        chunks.extend(pieces)
+        current.append(para)
+        size += len(para) + 2
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+def submit_batch(prompts: List[str], system: str = "", temperature: float = 0.7, max_tokens: int = 400) -> str:
+    """Upload prompts as a JSONL batch of chat completions and return the batch id."""
+    if not prompts:
+        raise ValueError("submit_batch needs at least one prompt")
+    lines = [
+        json.dumps({
+            "custom_id": f"req-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": OPENAI_MODEL,
+                "messages": _build_messages(prompt, system),
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+            },
+        })
+        for i, prompt in enumerate(prompts)
+    ]
+    batch_file = _upload_batch_file(file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+    batch = _create_batch(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+    return batch.id
+
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+def _batch_order(custom_id: str) -> int:
+    return int(custom_id.rsplit("-", 1)[1])
+
+def fetch_batch(batch_id: str) -> Tuple[str, Optional[List[str]], List[str]]:
+    """Return (status, responses in submission order, failed custom_ids).
+
+    responses is None while the batch is still running; once it has finished it holds every successful
+    response (possibly none), and requests that errored are listed in failed custom_ids instead.
+    """
+    batch = _retrieve_batch(batch_id)
+    if batch.status not in BATCH_FINAL_STATUSES:
+        return batch.status, None, []
+    results, failed = {}, set()
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in _file_text(file_id).splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            body = (record.get("response") or {}).get("body") or {}
+            choices = body.get("choices") or []
+            # content is null for refusals and filtered replies; count those as failed, not as a crash
+            content = (choices[0].get("message") or {}).get("content") if choices else None
+            if content and content.strip():
+                results[record["custom_id"]] = content.strip()
+            else:
+                failed.add(record["custom_id"])
+    return batch.status, [results[k] for k in sorted(results, key=_batch_order)], sorted(failed, key=_batch_order)
+
+# ---- Token budgeting (optional: needs tiktoken) ----
+@st.cache_resource(show_spinner=False)
+def _token_encoder():
+    """tiktoken encoding for OPENAI_MODEL, or None if tiktoken is unavailable."""
+    try:
+        import tiktoken
+    except Exception:
+        return None
+    try:
+        return tiktoken.encoding_for_model(OPENAI_MODEL)
+    except KeyError:
+        pass  # model unknown to this tiktoken version; use the current default encoding
+    except Exception:
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+def fit_to_budget(text: str, budget: int) -> str:
+    """Trim text to at most budget tokens (roughly 4 characters per token without tiktoken)."""
+    if len(text.encode("utf-8")) <= budget:  # a token is never shorter than one byte
+        return text
+    enc = _token_encoder()
+    if enc is None:
+        return text[:budget * 4]
+    tokens = enc.encode(text, disallowed_special=())
+    return enc.decode(tokens[:budget]) if len(tokens) > budget else text
+
+def input_budget(max_tokens: int) -> int:
+    """Tokens left for user text once the reply and prompt overhead are reserved."""
+    return max(OPENAI_CONTEXT_TOKENS - max_tokens - PROMPT_OVERHEAD_TOKENS, 0)
+
+# ---- Retrieval over uploaded notes ----
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """Embed texts with the OpenAI embeddings API; rows are unit length."""
+    vectors = []
+    for start in range(0, len(texts), 2048):  # API limit per request
+        resp = _create_embeddings(model=OPENAI_EMBEDDING_MODEL, input=texts[start:start + 2048])
+        vectors.extend(item.embedding for item in resp.data)
+    matrix = np.asarray(vectors, dtype=np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+# Re-asking a question (or asking it about another file) reuses its embedding instead of another API call
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def embed_query(question: str) -> np.ndarray:
+    return embed_texts([question])[0]
+
+# Same digest-keyed pattern as extract_pdf_text: each uploaded file is embedded once
+@st.cache_data(max_entries=16, show_spinner=False)
+def embed_chunks(digest: str, _chunks: List[str]) -> np.ndarray:
+    return embed_texts(_chunks)
+
+def retrieve_chunks(digest: str, text: str, question: str, k: int = RAG_TOP_K) -> List[str]:
+    """Return the k notes chunks most similar to the question, in document order."""
+    chunks = split_into_chunks(text, RAG_CHUNK_CHARS)
+    if len(chunks) <= k:
+        return chunks
+    matrix = embed_chunks(digest, chunks)
+    sims = matrix @ embed_query(question)
+    top = np.argsort(sims)[::-1][:k]
+    return [chunks[i] for i in sorted(top)]
 
 # ---- Small helpers & prompt templates ----
-PROMPTS = {
+TRANSFORMS = ["Shakespeare", "Rap", "Meme", "Sarcastic", "Roast", "Pirate", "Yoda", "Cowboy", "Poem"]
+NOTES_SECTIONS = ["Bullets", "Mindmap-style", "Timeline", "Flashcards"]
+NOTES_SECTION_DELIMITER = "===SECTION==="  # must match the separator requested in PROMPTS["notes_all"]
+
+PROMPTS = MappingProxyType({
     "summarize": "Summarize the following text into a short, clear summary (3-6 lines). Keep it simple and friendly: \n\n{input}",
     "improve": "Improve the following text so it sounds polished, professional, and concise. Keep original meaning:\n\n{input}",
     "explain_simple": "Explain the following concept like I'm {age} years old. Use simple language, examples, and a short summary at the end:\n\n{input}",
@@ -91,8 +688,66 @@ PROMPTS = {
     "creativity_joke": "Write a short, wholesome joke about: {topic}.",
     "notes_bullets": "Convert the following lecture notes into concise bullet points capturing the key ideas, terms, and actions to remember:\n\n{input}",
     "mindmap_like": "Given the following notes, return a short hierarchical list that could be turned into a mind map (root -> 3 main branches -> 2 subpoints each):\n\n{input}",
+    "notes_all": "Given the following notes, produce these four sections in order, separated by a line containing only '===SECTION===' (no titles or text outside the sections):\n"
+                 "1) Bullets: concise bullet points capturing the key ideas, terms, and actions to remember.\n"
+                 "2) Mindmap: a short hierarchical list that could be turned into a mind map (root -> 3 main branches -> 2 subpoints each).\n"
+                 "3) Timeline: a chronological timeline of events or key points.\n"
+                 "4) Flashcards: flashcards in question: answer format.\n\n{input}",
     "qa_tutor": "You are a helpful tutor. Answer the question in a clear and friendly way, include one quick example and a 2-line summary at the end. If the user asks for step-by-step, provide numbered steps. Question:\n\n{input}",
-}
+    "qa_notes": "Use the following notes to answer the question simply and understandably:\n\n{input}",
+    "qa_notes_part": "Use the following part of my notes to answer the question simply and understandably. If this part is not relevant, reply only with 'Not covered in this part.'\n\n{input}",
+})
+
+# Tone instruction appended to the system message (see apply_tone)
+_TONE = MappingProxyType({
+    "Friendly": "\nKeep the tone friendly and encouraging.",
+    "Formal": "\nUse a formal and professional tone.",
+    "Casual": "\nUse a casual, chatty tone with short sentences.",
+    "Funny": "\nAdd light humor where appropriate.",
+})
+
+# System message per template, built once at load: the template minus {input}.
+# None marks templates without {input}, which are sent whole as the user message.
+def _system_prompt(template: str) -> Optional[str]:
+    pre, sep, post = template.partition("{input}")
+    return (pre + post).strip() if sep else None
+
+_SYSTEM_PROMPTS = MappingProxyType({key: _system_prompt(template) for key, template in PROMPTS.items()})
+
+def file_digest(data: bytes) -> str:
+    """Short content hash used to key per-file caches."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+@st.cache_resource
+def _pdfium():
+    """pypdfium2, imported on first PDF upload (raises ImportError if missing)."""
+    import pypdfium2 as pdfium
+    return pdfium
+
+@st.cache_resource
+def _pdfium_lock() -> threading.Lock:
+    """Process-wide lock around PDFium, which is shared by every session's script thread."""
+    return threading.Lock()
+
+# Keyed on the digest only (Streamlit skips hashing _-prefixed args), so re-runs on the same upload are a dict lookup
+@st.cache_data(max_entries=16, show_spinner=False)
+def extract_pdf_text(digest: str, _data: bytes) -> str:
+    """Extract the text of every page with PDFium (pypdfium2), pages separated by a blank line."""
+    # PDFium isn't thread-safe, even across documents: hold the lock from open to close and read pages sequentially
+    with _pdfium_lock():
+        pdf = _pdfium().PdfDocument(_data)
+        try:
+            pages = []
+            for i in range(len(pdf)):
+                page = pdf[i]
+                textpage = page.get_textpage()
+                pages.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+            # PDFium ends lines with \r\n; a blank line between pages gives split_into_chunks a paragraph boundary
+            return "\n\n".join(page.replace("\r\n", "\n") for page in pages)
+        finally:
+            pdf.close()
 
 # ---- Streamlit UI ----
 st.set_page_config(page_title="Fun Personal Assistant", layout="wide")
@@ -122,7 +777,7 @@ mode = st.sidebar.radio("Choose a mode:", [
 
 # Shared inputs
 st.sidebar.markdown("---")
-user_tone = st.sidebar.selectbox("Response tone:", ["Friendly", "Formal", "Casual", "Funny"], index=0)
+user_tone = st.sidebar.selectbox("Response tone:", list(_TONE), index=0)
 max_tokens = st.sidebar.slider("Max tokens / length", 100, 1200, 400, step=50)
 temperature = st.sidebar.slider("Creativity (temperature)", 0.0, 1.2, 0.7, step=0.1)
 
@@ -133,13 +788,16 @@ transform = None
 topic = None
 kind = None
 style = None
+batch_mode = False
 
 if mode == "Fun Transform":
-    transform = st.sidebar.selectbox("Choose transform:", ["Shakespeare", "Rap", "Meme", "Sarcastic", "Roast", "Pirate", "Yoda", "Cowboy", "Poem"])
+    transform = st.sidebar.selectbox("Choose transform:", TRANSFORMS)
 elif mode == "Motivation":
     topic = st.sidebar.selectbox("Motivation topic:", ["studying", "procrastination", "stress", "success", "friendship"])
 elif mode == "Notes Organizer":
-    style = st.sidebar.selectbox("Notes output:", ["Bullets", "Mindmap-style", "Timeline", "Flashcards"])
+    style = st.sidebar.selectbox("Notes output:", NOTES_SECTIONS + ["All (one request)"])
+elif mode == "Q&A Chat (Tutor)":
+    batch_mode = st.sidebar.toggle("Batch mode (24h, 50% off)", help="Queue the question against every part of your notes via the OpenAI Batch API. Results arrive later; check back with 'Check batch status'.")
 
 # Example help
 if st.sidebar.button("Show example prompts"):
@@ -147,113 +805,195 @@ if st.sidebar.button("Show example prompts"):
 
 # Mode-specific main UI
 if mode in ["Summarize", "Improve Text", "Fun Transform", "Motivation", "Notes Organizer", "Q&A Chat (Tutor)"]:
-    input_text = st.text_area("Paste text / question here", height=250)
-    if mode == "Q&A Chat (Tutor)":
-        notes_file = st.file_uploader("Upload notes file (PDF or TXT)", type=["pdf", "txt"])
-    run_button = st.button("✨ Run")
+    # A form defers reruns until submit, instead of rerunning the script on every edit
+    with st.form("run_form"):
+        input_text = st.text_area("Paste text / question here", height=250)
+        if mode == "Q&A Chat (Tutor)":
+            notes_file = st.file_uploader("Upload notes file (PDF or TXT)", type=["pdf", "txt"])
+        run_button = st.form_submit_button("✨ Run")
+        compare_button = mode == "Fun Transform" and st.form_submit_button("🎭 Compare all styles")
 else:
     input_text = ""
     run_button = False
+    compare_button = False
 
 output_placeholder = st.empty()
 
 # Safety: minimal profanity filter (client-side simple)
+_BANNED: FrozenSet[str] = frozenset({"bomb", "kill", "suicide"})
+# One case-insensitive pass over the text, without building a lowercased copy of it
+_BANNED_RE = re.compile("|".join(re.escape(word) for word in sorted(_BANNED)), re.IGNORECASE)
+
 def simple_filter(text: str) -> bool:
-    banned = ["bomb", "kill", "suicide"]
-    lower = text.lower()
-    return not any(b in lower for b in banned)
+    return _BANNED_RE.search(text) is None
 
-# Format prompt with tone
+# Add the tone instruction to a system message
 def apply_tone(prompt: str, tone: str) -> str:
-    if tone == "Friendly":
-        return prompt + "\nKeep the tone friendly and encouraging."
-    if tone == "Formal":
-        return prompt + "\nUse a formal and professional tone."
-    if tone == "Casual":
-        return prompt + "\nUse a casual, chatty tone with short sentences."
-    if tone == "Funny":
-        return prompt + "\nAdd light humor where appropriate."
-    return prompt
+    return prompt + _TONE.get(tone, "")
+
+def build_prompt(key: str, tone: str, **fields) -> Tuple[str, str]:
+    """Return (system, user) messages for a PROMPTS template.
+
+    The instruction and tone go into the system message; the user message is just the {input} text.
+    Templates without {input} (e.g. motivation) are sent whole as the user message, with only the tone as system.
+    """
+    system = _SYSTEM_PROMPTS[key]
+    if system is None:
+        return apply_tone("", tone).strip(), PROMPTS[key].format(**fields)
+    if len(fields) > 1:  # extra placeholders besides {input}, e.g. {age}
+        system = system.format(**fields)
+    return apply_tone(system, tone), fields["input"]
 
 # Run logic
-if run_button:
+if run_button or compare_button:
     if not input_text.strip():
         st.warning("Please paste some text or a question first.")
     elif not simple_filter(input_text):
         st.error("Your input triggers the simple safety filter. Please modify and try again.")
     else:
+        # Over-long pastes are cut to what fits in the model's context window instead of failing the request
+        reply_tokens = max_tokens * len(NOTES_SECTIONS) if style == "All (one request)" else max_tokens
+        trimmed = fit_to_budget(input_text, input_budget(reply_tokens))
+        if len(trimmed) < len(input_text):
+            st.caption("✂️ Your text was trimmed to fit the model's context window.")
+            input_text = trimmed
         with st.spinner("Thinking..."):
             if mode == "Summarize":
-                prompt = PROMPTS["summarize"].format(input=input_text)
-                prompt = apply_tone(prompt, user_tone)
-                resp = call_openai(prompt, temperature=temperature, max_tokens=max_tokens)
-                output_placeholder.markdown("**Summary:**\n" + resp)
+                system, prompt = build_prompt("summarize", user_tone, input=input_text)
+                render_response(output_placeholder, prompt, system, temperature=temperature, max_tokens=max_tokens, prefix="**Summary:**\n")
 
             elif mode == "Improve Text":
-                prompt = PROMPTS["improve"].format(input=input_text)
-                prompt = apply_tone(prompt, user_tone)
-                resp = call_openai(prompt, temperature=temperature, max_tokens=max_tokens)
+                system, prompt = build_prompt("improve", user_tone, input=input_text)
                 st.subheader("Improved text")
-                output_placeholder.code(resp)
+                render_response(output_placeholder, prompt, system, temperature=temperature, max_tokens=max_tokens, as_code=True)
+
+            elif mode == "Fun Transform" and compare_button:
+                # All styles at once: requests run concurrently, each cell fills in as its response lands
+                prompts = {name: build_prompt(name.lower(), user_tone, input=input_text) for name in TRANSFORMS}
+                cells = {}
+                with output_placeholder.container():
+                    names = iter(TRANSFORMS)
+                    for _ in range(0, len(TRANSFORMS), 3):
+                        for col, name in zip(st.columns(3), names):
+                            cells[name] = col.empty()
+                            cells[name].markdown(f"**{name}:** ⏳")
+                call_openai_many(prompts, temperature=temperature, max_tokens=max_tokens,
+                                 on_result=lambda name, text: cells[name].markdown(f"**{name}:**\n{text}"))
 
             elif mode == "Fun Transform":
-                key = transform.lower()
-                prompt = PROMPTS[key].format(input=input_text)
-                prompt = apply_tone(prompt, user_tone)
-                resp = call_openai(prompt, temperature=temperature, max_tokens=max_tokens)
-                output_placeholder.markdown(f"**{transform} version:**\n{resp}")
+                system, prompt = build_prompt(transform.lower(), user_tone, input=input_text)
+                render_response(output_placeholder, prompt, system, temperature=temperature, max_tokens=max_tokens, prefix=f"**{transform} version:**\n")
 
             elif mode == "Motivation":
-                prompt = PROMPTS["motivation"].format(topic=topic)
-                prompt = apply_tone(prompt, user_tone)
-                resp = call_openai(prompt, temperature=temperature, max_tokens=80)
-                output_placeholder.markdown(f"📝 **Quote:** {resp}")
+                system, prompt = build_prompt("motivation", user_tone, topic=topic)
+                render_response(output_placeholder, prompt, system, temperature=temperature, max_tokens=80, prefix="📝 **Quote:** ")
+
+            elif mode == "Notes Organizer" and style == "All (one request)":
+                # One call for all four sections: the notes are sent (and billed) once instead of four times
+                system, prompt = build_prompt("notes_all", user_tone, input=input_text)
+                resp = render_response(output_placeholder, prompt, system, temperature=0.3, max_tokens=max_tokens * len(NOTES_SECTIONS))
+                sections = [part.strip() for part in resp.split(NOTES_SECTION_DELIMITER) if part.strip()]
+                if len(sections) == len(NOTES_SECTIONS):
+                    with output_placeholder.container():
+                        for tab, section in zip(st.tabs(NOTES_SECTIONS), sections):
+                            tab.markdown(section)
 
             elif mode == "Notes Organizer":
                 if style == "Bullets":
-                    prompt = PROMPTS["notes_bullets"].format(input=input_text)
+                    key = "notes_bullets"
                 elif style == "Mindmap-style":
-                    prompt = PROMPTS["mindmap_like"].format(input=input_text)
+                    key = "mindmap_like"
                 elif style == "Timeline":
-                    prompt = PROMPTS["timeline"].format(input=input_text)
+                    key = "timeline"
                 elif style == "Flashcards":
-                    prompt = PROMPTS["flashcards"].format(input=input_text)
+                    key = "flashcards"
                 else:
-                    prompt = PROMPTS["notes_bullets"].format(input=input_text)
-                prompt = apply_tone(prompt, user_tone)
-                resp = call_openai(prompt, temperature=0.3, max_tokens=max_tokens)
-                output_placeholder.markdown(resp)
+                    key = "notes_bullets"
+                system, prompt = build_prompt(key, user_tone, input=input_text)
+                render_response(output_placeholder, prompt, system, temperature=0.3, max_tokens=max_tokens)
 
             elif mode == "Q&A Chat (Tutor)":
                 # If notes file uploaded, extract text and prepend to prompt
                 context_text = ""
+                notes_digest = ""
                 if notes_file is not None:
                     try:
-                        import PyPDF2
+                        notes_data = notes_file.getvalue()
+                        notes_digest = file_digest(notes_data)
+                        if notes_file.type == "application/pdf":
+                            context_text = extract_pdf_text(notes_digest, notes_data)
+                        else:
+                            # For txt files
+                            context_text = notes_data.decode("utf-8")
                     except ImportError:
-                        st.error("PyPDF2 module not installed. Please install it to enable PDF file uploads.")
-                        context_text = ""
+                        st.error("pypdfium2 module not installed. Please install it to enable PDF file uploads.")
+                    except Exception as e:
+                        st.error(f"Error reading notes file: {e}")
+                if batch_mode:
+                    # One request per notes chunk, queued for the Batch API instead of answered live
+                    # Notes without any text (e.g. a scanned PDF) yield no chunks, so fall back to the tutor prompt
+                    chunks = split_into_chunks(context_text, BATCH_CHUNK_CHARS) if context_text else []
+                    if chunks:
+                        system, _ = build_prompt("qa_notes_part", user_tone, input="")
+                        prompts = [f"Notes:\n{chunk}\n\nQuestion:\n{input_text}" for chunk in chunks]
+                    else:
+                        system, prompt = build_prompt("qa_tutor", user_tone, input=input_text)
+                        prompts = [prompt]
+                    error = _client_error()
+                    if error:
+                        st.error(error)
                     else:
                         try:
-                            if notes_file.type == "application/pdf":
-                                pdf_reader = PyPDF2.PdfReader(notes_file)
-                                for page in pdf_reader.pages:
-                                    context_text += page.extract_text() + "\n"
-                            else:
-                                # For txt files
-                                context_text = notes_file.getvalue().decode("utf-8")
+                            batch_id = submit_batch(prompts, system, temperature=temperature, max_tokens=max_tokens)
                         except Exception as e:
-                            st.error(f"Error reading notes file: {e}")
-                prompt = PROMPTS["qa_tutor"].format(input=input_text)
-                if context_text:
-                    prompt = f"Use the following notes to answer the question simply and understandably:\n{context_text}\nQuestion:\n{input_text}"
-                prompt = apply_tone(prompt, user_tone)
-                resp = call_openai(prompt, temperature=temperature, max_tokens=max_tokens)
-                output_placeholder.markdown(resp)
+                            st.error(f"OpenAI Batch API error: {e}")
+                        else:
+                            st.session_state["batch_job"] = {"id": batch_id, "question": input_text, "requests": len(prompts)}
+                            output_placeholder.info(f"Queued {len(prompts)} request(s) as batch `{batch_id}`. Results arrive within 24h — use 'Check batch status' below.")
+                else:
+                    if context_text and not _client_error():
+                        # Only send the parts of the notes relevant to the question, not the whole file
+                        try:
+                            context_text = "\n\n".join(retrieve_chunks(notes_digest, context_text, input_text))
+                        except Exception as e:
+                            st.caption(f"Note retrieval unavailable, sending the full notes ({e})")
+                        context_text = fit_to_budget(context_text, max(input_budget(max_tokens) - len(input_text.encode("utf-8")), 0))
+                    if context_text:
+                        system, prompt = build_prompt("qa_notes", user_tone, input=f"Notes:\n{context_text}\n\nQuestion:\n{input_text}")
+                    else:
+                        system, prompt = build_prompt("qa_tutor", user_tone, input=input_text)
+                    # Only plain questions use the semantic cache: a rephrased question has the same answer, whereas
+                    # drafts and notes that differ slightly (a fixed typo, another file) must not reuse an old response
+                    scope = None if context_text else f"{mode}|{user_tone}|{temperature}|{max_tokens}"
+                    render_response(output_placeholder, prompt, system, temperature=temperature, max_tokens=max_tokens,
+                                    scope=scope, query=input_text)
 
             else:
                 output_placeholder.text("Mode not implemented yet.")
 
+# Batch results (Q&A batch mode): poll on demand, render once completed
+batch_job = st.session_state.get("batch_job")
+if batch_job and mode == "Q&A Chat (Tutor)":
+    st.markdown(f"**Queued batch** `{batch_job['id']}` — {batch_job['requests']} request(s) for: _{batch_job['question']}_")
+    if st.button("🔄 Check batch status"):
+        try:
+            status, answers, failed = fetch_batch(batch_job["id"])
+        except Exception as e:
+            st.error(f"OpenAI Batch API error: {e}")
+        else:
+            if answers is None:
+                st.info(f"Batch status: {status}. Check again later.")
+            else:
+                if status != "completed":
+                    st.error(f"Batch {status}.")
+                if failed:
+                    st.warning(f"{len(failed)} of {batch_job['requests']} request(s) failed: {', '.join(failed)}")
+                if answers:
+                    relevant = [a for a in answers if "Not covered in this part" not in a] or answers
+                    st.markdown("\n\n---\n\n".join(relevant))
+                elif status == "completed":
+                    st.error("No answers came back from this batch.")
+
 # Footer: tips and export
 st.sidebar.markdown("---")
 if st.sidebar.button("Download last output as .txt"):
@@ -264,6 +1004,9 @@ if st.sidebar.button("Download last output as .txt"):
     except Exception:
         st.sidebar.error("Could not prepare download in demo mode.")
 
+cache = _response_cache()
+st.sidebar.caption(f"♻️ Response cache: {cache['hits']} hits / {cache['misses']} misses")
+
 st.markdown("---")
 st.caption("Built for students — keep it friendly. You can hook any LLM backend into the `call_openai` function.")
 